@@ -2,10 +2,11 @@ import argparse
 import cv2
 import glob
 import os
+import queue
 from basicsr.archs.rrdbnet_arch import RRDBNet
 from basicsr.utils.download_util import load_file_from_url
 
-from realesrgan import RealESRGANer
+from realesrgan import IOConsumer, RealESRGANer
 from realesrgan.archs.srvgg_arch import SRVGGNetCompact
 
 
@@ -51,8 +52,11 @@ def main():
         help='Image extension. Options: auto | jpg | png, auto means using the same extension as inputs')
     parser.add_argument(
         '-g', '--gpu-id', type=int, default=None, help='gpu device to use (default=None) can be 0,1,2 for multi-gpu')
+    parser.add_argument('--consumer', type=int, default=4, help='Number of IO threads that save the results')
 
     args = parser.parse_args()
+    if args.consumer < 1:
+        parser.error('--consumer should be a positive integer')
 
     # determine models according to model names
     args.model_name = args.model_name.split('.')[0]
@@ -130,36 +134,58 @@ def main():
     else:
         paths = sorted(glob.glob(os.path.join(args.input, '*')))
 
-    for idx, path in enumerate(paths):
-        imgname, extension = os.path.splitext(os.path.basename(path))
-        print('Testing', idx, imgname)
+    # save results in background threads. The queue is bounded, so that the inference blocks instead of piling up
+    # results in memory when saving is slower
+    que = queue.Queue(maxsize=2 * args.consumer)
+    consumers = [IOConsumer(args, que, f'IO_{i}') for i in range(args.consumer)]
+    for consumer in consumers:
+        consumer.start()
 
-        img = cv2.imread(path, cv2.IMREAD_UNCHANGED)
-        if len(img.shape) == 3 and img.shape[2] == 4:
-            img_mode = 'RGBA'
-        else:
-            img_mode = None
+    # None means using the same extension as each input
+    save_ext = None if args.ext == 'auto' else args.ext
 
-        try:
-            if args.face_enhance:
-                _, _, output = face_enhancer.enhance(img, has_aligned=False, only_center_face=False, paste_back=True)
-            else:
-                output, _ = upsampler.enhance(img, outscale=args.outscale)
-        except RuntimeError as error:
-            print('Error', error)
-            print('If you encounter CUDA out of memory, try to set --tile with a smaller number.')
-        else:
-            if args.ext == 'auto':
-                extension = extension[1:]
-            else:
-                extension = args.ext
-            if img_mode == 'RGBA':  # RGBA images should be saved in png format
-                extension = 'png'
-            if args.suffix == '':
-                save_path = os.path.join(args.output, f'{imgname}.{extension}')
+    try:
+        for idx, path in enumerate(paths):
+            imgname, extension = os.path.splitext(os.path.basename(path))
+            print('Testing', idx, imgname)
+
+            img = cv2.imread(path, cv2.IMREAD_UNCHANGED)
+            # checked per image, as a folder may mix RGB and RGBA images
+            is_rgba = img.ndim == 3 and img.shape[2] == 4
+
+            try:
+                if args.face_enhance:
+                    _, _, output = face_enhancer.enhance(
+                        img, has_aligned=False, only_center_face=False, paste_back=True)
+                else:
+                    output, _ = upsampler.enhance(img, outscale=args.outscale)
+            except RuntimeError as error:
+                print('Error', error)
+                print('If you encounter CUDA out of memory, try to set --tile with a smaller number.')
             else:
-                save_path = os.path.join(args.output, f'{imgname}_{args.suffix}.{extension}')
-            cv2.imwrite(save_path, output)
+                if is_rgba:  # RGBA images should be saved in png format
+                    extension = 'png'
+                else:
+                    extension = save_ext or extension[1:]
+                if args.suffix == '':
+                    save_path = os.path.join(args.output, f'{imgname}.{extension}')
+                else:
+                    save_path = os.path.join(args.output, f'{imgname}_{args.suffix}.{extension}')
+                que.put({'output': output, 'save_path': save_path})
+                # stop at the first image that a consumer failed to save
+                for consumer in consumers:
+                    if consumer.error is not None:
+                        raise consumer.error
+    finally:
+        # also stop the consumers when the loop fails, as they would keep the process alive
+        for _ in range(args.consumer):
+            que.put('quit')
+        for consumer in consumers:
+            consumer.join()
+    # errors in saving the last images
+    for consumer in consumers:
+        if consumer.error is not None:
+            raise consumer.error
 
 
 if __name__ == '__main__':
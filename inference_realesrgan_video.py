@@ -12,7 +12,7 @@ from basicsr.utils.download_util import load_file_from_url
 from os import path as osp
 from tqdm import tqdm
 
-from realesrgan import RealESRGANer
+from realesrgan import PrefetchReader, RealESRGANer
 from realesrgan.archs.srvgg_arch import SRVGGNetCompact
 
 try:
@@ -23,6 +23,42 @@ except ImportError:
     import ffmpeg
 
 
+def set_pipe_size(pipe, size=1 << 20):
+    """Enlarge the kernel buffer of a pipe. Only Linux supports it, and the size is capped by
+    /proc/sys/fs/pipe-max-size, so failures are ignored and the default buffer is kept."""
+    try:
+        import fcntl
+        fcntl.fcntl(pipe.fileno(), getattr(fcntl, 'F_SETPIPE_SZ', 1031), size)
+    except (ImportError, OSError):
+        pass
+
+
+def run_ffmpeg_async(stream, cmd):
+    """The same as ``stream.run_async(pipe_stdin=True, pipe_stdout=True, cmd=cmd)``, but the pipes are unbuffered,
+    so that raw frames go between the numpy buffers and the pipes without a copy into a Python-side buffer."""
+    process = subprocess.Popen(
+        ffmpeg.compile(stream, cmd=cmd), stdin=subprocess.PIPE, stdout=subprocess.PIPE, bufsize=0)
+    set_pipe_size(process.stdin)
+    set_pipe_size(process.stdout)
+    return process
+
+
+def bgr2yuv420p(img):
+    """Convert a HWC-BGR uint8 tensor to packed planar yuv420p (BT.601, limited range) on its own device.
+
+    The height and width must be even. It halves the bytes sent through the ffmpeg pipe compared with bgr24, and
+    spares ffmpeg the colorspace conversion on the CPU.
+    """
+    h, w = img.shape[0:2]
+    b, g, r = img.float().unbind(2)
+    y = 0.257 * r + 0.504 * g + 0.098 * b + 16
+    # subsample chroma by averaging 2x2 blocks
+    b, g, r = (c.view(h // 2, 2, w // 2, 2).mean((1, 3)) for c in (b, g, r))
+    u = -0.148 * r - 0.291 * g + 0.439 * b + 128
+    v = 0.439 * r - 0.368 * g - 0.071 * b + 128
+    return torch.cat([y.flatten(), u.flatten(), v.flatten()]).round_().clamp_(0, 255).to(torch.uint8)
+
+
 def get_video_meta_info(video_path):
     ret = {}
     probe = ffmpeg.probe(video_path)
@@ -30,7 +66,9 @@ def get_video_meta_info(video_path):
     has_audio = any(stream['codec_type'] == 'audio' for stream in probe['streams'])
     ret['width'] = video_streams[0]['width']
     ret['height'] = video_streams[0]['height']
-    ret['fps'] = eval(video_streams[0]['avg_frame_rate'])
+    # avg_frame_rate is a fraction such as '30000/1001', and it is '0/0' when ffprobe cannot determine it
+    num, den = video_streams[0]['avg_frame_rate'].split('/')
+    ret['fps'] = float(num) / float(den) if float(den) else 24
     ret['audio'] = ffmpeg.input(video_path).audio if has_audio else None
     ret['nb_frames'] = int(video_streams[0]['nb_frames'])
     return ret
@@ -56,22 +94,25 @@ def get_sub_video(args, num_process, process_idx):
 
 class Reader:
 
-    def __init__(self, args, total_workers=1, worker_idx=0):
+    def __init__(self, args, total_workers=1, worker_idx=0, device=None):
         self.args = args
+        self.device = device
         input_type = mimetypes.guess_type(args.input)[0]
         self.input_type = 'folder' if input_type is None else input_type
         self.paths = []  # for image&folder type
         self.audio = None
         self.input_fps = None
+        # set once the last frame has been read. The prefetch reader signals its end only once, so it must not be
+        # read again after a partial last batch
+        self.exhausted = False
         if self.input_type.startswith('video'):
             video_path = get_sub_video(args, total_workers, worker_idx)
-            self.stream_reader = (
-                ffmpeg.input(video_path).output('pipe:', format='rawvideo', pix_fmt='bgr24',
-                                                loglevel='error').run_async(
-                                                    pipe_stdin=True, pipe_stdout=True, cmd=args.ffmpeg_bin))
             meta = get_video_meta_info(video_path)
             self.width = meta['width']
             self.height = meta['height']
+            self.stream_reader = run_ffmpeg_async(
+                ffmpeg.input(video_path).output('pipe:', format='rawvideo', pix_fmt='bgr24', loglevel='error'),
+                cmd=args.ffmpeg_bin)
             self.input_fps = meta['fps']
             self.audio = meta['audio']
             self.nb_frames = meta['nb_frames']
@@ -90,7 +131,18 @@ class Reader:
             from PIL import Image
             tmp_img = Image.open(self.paths[0])
             self.width, self.height = tmp_img.size
-        self.idx = 0
+            # decode images in a background thread, bounded so that it cannot run far ahead of the inference
+            self.prefetch_reader = PrefetchReader(self.paths, num_prefetch_queue=4, flags=cv2.IMREAD_COLOR)
+            self.prefetch_reader.start()
+
+        # batches of frames are staged in two pinned buffers and uploaded on a side stream, so that the
+        # host-to-device copy of the next batch overlaps with the inference of the current one
+        self.host_bufs = [None, None]
+        self.slot = 0
+        self.copy_stream = None
+        if device is not None and device.type == 'cuda':
+            self.copy_stream = torch.cuda.Stream(device)
+            self.copy_events = [torch.cuda.Event(), torch.cuda.Event()]
 
     def get_resolution(self):
         return self.height, self.width
@@ -108,64 +160,168 @@ class Reader:
     def __len__(self):
         return self.nb_frames
 
-    def get_frame_from_stream(self):
-        img_bytes = self.stream_reader.stdout.read(self.width * self.height * 3)  # 3 bytes for one pixel
-        if not img_bytes:
-            return None
-        img = np.frombuffer(img_bytes, np.uint8).reshape([self.height, self.width, 3])
+    def get_frame_from_stream(self, out=None):
+        """Read one frame from the ffmpeg pipe into ``out`` (or a new array), without an intermediate bytes object."""
+        img = np.empty((self.height, self.width, 3), dtype=np.uint8) if out is None else out
+        buf = memoryview(img).cast('B')
+        num_read = 0
+        while num_read < len(buf):
+            size = self.stream_reader.stdout.readinto(buf[num_read:])
+            if not size:
+                return None
+            num_read += size
         return img
 
     def get_frame_from_list(self):
-        if self.idx >= self.nb_frames:
-            return None
-        img = cv2.imread(self.paths[self.idx])
-        self.idx += 1
-        return img
+        return next(self.prefetch_reader, None)
 
     def get_frame(self):
+        if self.exhausted:
+            return None
         if self.input_type.startswith('video'):
-            return self.get_frame_from_stream()
+            img = self.get_frame_from_stream()
         else:
-            return self.get_frame_from_list()
+            img = self.get_frame_from_list()
+        self.exhausted = img is None
+        return img
+
+    def get_frames(self, num):
+        """Read up to ``num`` frames as one (n, h, w, 3) uint8 tensor on the device of the Reader.
+
+        Returns None when there are no frames left.
+        """
+        if self.exhausted:
+            return None
+        slot = self.slot
+        self.slot = 1 - slot
+        if self.copy_stream is not None:
+            # wait until the previous copy out of this staging buffer has finished
+            self.copy_events[slot].synchronize()
+        if self.host_bufs[slot] is None or len(self.host_bufs[slot]) < num:
+            self.host_bufs[slot] = torch.empty((num, self.height, self.width, 3),
+                                               dtype=torch.uint8,
+                                               pin_memory=self.copy_stream is not None)
+        host_buf = self.host_bufs[slot]
+
+        num_frames = 0
+        while num_frames < num:
+            if self.input_type.startswith('video'):
+                # the pipe is read straight into the staging buffer
+                if self.get_frame_from_stream(out=host_buf[num_frames].numpy()) is None:
+                    self.exhausted = True
+                    break
+            else:
+                img = self.get_frame_from_list()
+                if img is None:
+                    self.exhausted = True
+                    break
+                if img.shape != host_buf.shape[1:]:
+                    raise ValueError(f'All frames should have the same size, but got {img.shape[1::-1]} and '
+                                     f'{(self.width, self.height)}.')
+                np.copyto(host_buf[num_frames].numpy(), img)
+            num_frames += 1
+        if num_frames == 0:
+            return None
+        if self.copy_stream is None:
+            return host_buf[:num_frames]
+
+        with torch.cuda.stream(self.copy_stream):
+            device_imgs = host_buf[:num_frames].to(self.device, non_blocking=True)
+            self.copy_events[slot].record(self.copy_stream)
+        compute_stream = torch.cuda.current_stream(self.device)
+        compute_stream.wait_stream(self.copy_stream)
+        # the tensor is allocated on the copy stream but consumed on the compute stream
+        device_imgs.record_stream(compute_stream)
+        return device_imgs
 
     def close(self):
         if self.input_type.startswith('video'):
             self.stream_reader.stdin.close()
+            # ffmpeg exits on the closed pipe if it has frames left, e.g., when the inference fails
+            self.stream_reader.stdout.close()
             self.stream_reader.wait()
+        else:
+            self.prefetch_reader.stop()
 
 
 class Writer:
 
-    def __init__(self, args, audio, height, width, video_save_path, fps):
+    def __init__(self, args, audio, height, width, video_save_path, fps, device=None):
         out_width, out_height = int(width * args.outscale), int(height * args.outscale)
         if out_height > 2160:
             print('You are generating video that is larger than 4K, which will be very slow due to IO speed.',
                   'We highly recommend to decrease the outscale(aka, -s).')
 
+        # device frames are converted to yuv420p on the GPU; yuv420p needs even sizes
+        use_cuda = device is not None and device.type == 'cuda'
+        if use_cuda and out_width % 2 == 0 and out_height % 2 == 0:
+            self.pix_fmt = 'yuv420p'
+            frame_shape = (out_height * out_width * 3 // 2, )
+        else:
+            self.pix_fmt = 'bgr24'
+            frame_shape = (out_height, out_width, 3)
+
         if audio is not None:
-            self.stream_writer = (
-                ffmpeg.input('pipe:', format='rawvideo', pix_fmt='bgr24', s=f'{out_width}x{out_height}',
-                             framerate=fps).output(
-                                 audio,
-                                 video_save_path,
-                                 pix_fmt='yuv420p',
-                                 vcodec='libx264',
-                                 loglevel='error',
-                                 acodec='copy').overwrite_output().run_async(
-                                     pipe_stdin=True, pipe_stdout=True, cmd=args.ffmpeg_bin))
+            stream = ffmpeg.input(
+                'pipe:', format='rawvideo', pix_fmt=self.pix_fmt, s=f'{out_width}x{out_height}', framerate=fps).output(
+                    audio, video_save_path, pix_fmt='yuv420p', vcodec='libx264', loglevel='error', acodec='copy')
         else:
-            self.stream_writer = (
-                ffmpeg.input('pipe:', format='rawvideo', pix_fmt='bgr24', s=f'{out_width}x{out_height}',
-                             framerate=fps).output(
-                                 video_save_path, pix_fmt='yuv420p', vcodec='libx264',
-                                 loglevel='error').overwrite_output().run_async(
-                                     pipe_stdin=True, pipe_stdout=True, cmd=args.ffmpeg_bin))
+            stream = ffmpeg.input(
+                'pipe:', format='rawvideo', pix_fmt=self.pix_fmt, s=f'{out_width}x{out_height}', framerate=fps).output(
+                    video_save_path, pix_fmt='yuv420p', vcodec='libx264', loglevel='error')
+        self.stream_writer = run_ffmpeg_async(stream.overwrite_output(), cmd=args.ffmpeg_bin)
+
+        # device frames are downloaded into pinned memory on a side stream; frame i is written to ffmpeg only
+        # after frame i+1 has been queued, so that encoding overlaps with inference
+        self.copy_stream = None
+        if use_cuda:
+            self.copy_stream = torch.cuda.Stream(device)
+            self.device = device
+            self.host_bufs = [torch.empty(frame_shape, dtype=torch.uint8, pin_memory=True) for _ in range(2)]
+            self.slot = 0
+        self.pending = None
 
     def write_frame(self, frame):
-        frame = frame.astype(np.uint8).tobytes()
-        self.stream_writer.stdin.write(frame)
+        if isinstance(frame, torch.Tensor):
+            self.write_tensor(frame)
+            return
+        if frame.dtype != np.uint8:
+            frame = frame.astype(np.uint8)
+        # the array buffer, e.g., a pinned download buffer, goes straight to the unbuffered pipe, without the copy
+        # made by tobytes(). A raw write may be short, so it is repeated until the whole frame is sent
+        buf = memoryview(np.ascontiguousarray(frame)).cast('B')
+        num_written = 0
+        while num_written < len(buf):
+            num_written += self.stream_writer.stdin.write(buf[num_written:])
+
+    def write_tensor(self, frame):
+        if self.copy_stream is None:
+            self.write_frame(frame.cpu().numpy())
+            return
+
+        if self.pix_fmt == 'yuv420p':
+            frame = bgr2yuv420p(frame)
+        host_buf = self.host_bufs[self.slot]
+        self.slot = 1 - self.slot
+        self.copy_stream.wait_stream(torch.cuda.current_stream(self.device))
+        with torch.cuda.stream(self.copy_stream):
+            host_buf.copy_(frame, non_blocking=True)
+            # the frame is allocated on the compute stream but consumed on the copy stream
+            frame.record_stream(self.copy_stream)
+            event = self.copy_stream.record_event()
+        self.flush()
+        self.pending = (host_buf, event)
+
+    def flush(self):
+        if self.pending is None:
+            return
+        host_buf, event = self.pending
+        self.pending = None
+        event.synchronize()
+        self.write_frame(host_buf.numpy())
 
     def close(self):
+        self.flush()
         self.stream_writer.stdin.close()
         self.stream_writer.wait()
 
@@ -228,6 +384,8 @@ def inference_video(args, video_save_path, device=None, total_workers=1, worker_
         pre_pad=args.pre_pad,
         half=not args.fp32,
         device=device,
+        channels_last=True,
+        cuda_graph=True,
     )
 
     if 'anime' in args.model_name and args.face_enhance:
@@ -246,33 +404,46 @@ def inference_video(args, video_save_path, device=None, total_workers=1, worker_
     else:
         face_enhancer = None
 
-    reader = Reader(args, total_workers, worker_idx)
+    # face enhancement works on numpy images; otherwise frames stay on the device between reading and writing
+    tensor_device = None if args.face_enhance else upsampler.device
+    reader = Reader(args, total_workers, worker_idx, device=tensor_device)
     audio = reader.get_audio()
     height, width = reader.get_resolution()
     fps = reader.get_fps()
-    writer = Writer(args, audio, height, width, video_save_path, fps)
+    writer = Writer(args, audio, height, width, video_save_path, fps, device=tensor_device)
 
-    pbar = tqdm(total=len(reader), unit='frame', desc='inference')
-    while True:
-        img = reader.get_frame()
-        if img is None:
-            break
-
-        try:
-            if args.face_enhance:
-                _, _, output = face_enhancer.enhance(img, has_aligned=False, only_center_face=False, paste_back=True)
-            else:
-                output, _ = upsampler.enhance(img, outscale=args.outscale)
-        except RuntimeError as error:
-            print('Error', error)
-            print('If you encounter CUDA out of memory, try to set --tile with a smaller number.')
-        else:
-            writer.write_frame(output)
+    # all frames have the same shape, so the cudnn autotuning is paid only once
+    torch.backends.cudnn.benchmark = True
+    # torch.inference_mode is only available in torch >= 1.9
+    inference_mode = getattr(torch, 'inference_mode', torch.no_grad)
 
-        torch.cuda.synchronize(device)
-        pbar.update(1)
-
-    reader.close()
+    pbar = tqdm(total=len(reader), unit='frame', desc='inference')
+    try:
+        with inference_mode():
+            while True:
+                # face enhancement handles one numpy frame at a time
+                imgs = [reader.get_frame()] if args.face_enhance else reader.get_frames(args.batch)
+                if imgs is None or imgs[0] is None:
+                    break
+
+                try:
+                    if args.face_enhance:
+                        _, _, output = face_enhancer.enhance(
+                            imgs[0], has_aligned=False, only_center_face=False, paste_back=True)
+                        outputs = [output]
+                    else:
+                        outputs = upsampler.enhance_tensor(imgs, outscale=args.outscale)
+                except RuntimeError as error:
+                    print('Error', error)
+                    print('If you encounter CUDA out of memory, try to set --tile or --batch with a smaller number.')
+                else:
+                    for output in outputs:
+                        writer.write_frame(output)
+
+                pbar.update(len(imgs))
+    finally:
+        # also stop the reader on errors, as its thread would keep the process alive
+        reader.close()
     writer.close()
 
 
@@ -280,12 +451,6 @@ def run(args):
     args.video_name = osp.splitext(os.path.basename(args.input))[0]
     video_save_path = osp.join(args.output, f'{args.video_name}_{args.suffix}.mp4')
 
-    if args.extract_frame_first:
-        tmp_frames_folder = osp.join(args.output, f'{args.video_name}_inp_tmp_frames')
-        os.makedirs(tmp_frames_folder, exist_ok=True)
-        os.system(f'ffmpeg -i {args.input} -qscale:v 1 -qmin 1 -qmax 1 -vsync 0  {tmp_frames_folder}/frame%08d.png')
-        args.input = tmp_frames_folder
-
     num_gpus = torch.cuda.device_count()
     num_process = num_gpus * args.num_process_per_gpu
     if num_process == 1:
@@ -356,8 +521,12 @@ def main():
         '--fp32', action='store_true', help='Use fp32 precision during inference. Default: fp16 (half precision).')
     parser.add_argument('--fps', type=float, default=None, help='FPS of the output video')
     parser.add_argument('--ffmpeg_bin', type=str, default='ffmpeg', help='The path to ffmpeg')
-    parser.add_argument('--extract_frame_first', action='store_true')
     parser.add_argument('--num_process_per_gpu', type=int, default=1)
+    parser.add_argument(
+        '--batch',
+        type=int,
+        default=1,
+        help='Number of frames upsampled together. Larger batches help small models such as realesr-animevideov3')
 
     parser.add_argument(
         '--alpha_upsampler',
@@ -370,29 +539,22 @@ def main():
         default='auto',
         help='Image extension. Options: auto | jpg | png, auto means using the same extension as inputs')
     args = parser.parse_args()
+    if args.batch < 1:
+        parser.error('--batch should be a positive integer')
 
     args.input = args.input.rstrip('/').rstrip('\\')
     os.makedirs(args.output, exist_ok=True)
 
-    if mimetypes.guess_type(args.input)[0] is not None and mimetypes.guess_type(args.input)[0].startswith('video'):
-        is_video = True
-    else:
-        is_video = False
+    input_type = mimetypes.guess_type(args.input)[0]
+    is_video = input_type is not None and input_type.startswith('video')
 
     if is_video and args.input.endswith('.flv'):
         mp4_path = args.input.replace('.flv', '.mp4')
         os.system(f'ffmpeg -i {args.input} -codec copy {mp4_path}')
         args.input = mp4_path
 
-    if args.extract_frame_first and not is_video:
-        args.extract_frame_first = False
-
     run(args)
 
-    if args.extract_frame_first:
-        tmp_frames_folder = osp.join(args.output, f'{args.video_name}_inp_tmp_frames')
-        shutil.rmtree(tmp_frames_folder)
-
 
 if __name__ == '__main__':
     main()
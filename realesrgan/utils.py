@@ -6,11 +6,69 @@ import queue
 import threading
 import torch
 from basicsr.utils.download_util import load_file_from_url
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
 from torch.nn import functional as F
 
 ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 
 
+@lru_cache()
+def lanczos4_table(in_size, out_size):
+    """Source indices and fixed-point weights of ``cv2.resize`` with ``cv2.INTER_LANCZOS4`` along one axis.
+
+    It follows the arithmetic of OpenCV for uint8 images (float32 coordinates and coefficients, weights scaled by
+    2048 and rounded, replicated borders), so that :func:`resize_lanczos4` is bit-exact with OpenCV.
+
+    Returns:
+        tuple[ndarray]: Indices with shape (out_size, 8) and int32 weights with shape (out_size, 8).
+    """
+    scale = 1. / (out_size / in_size)
+    fx = ((np.arange(out_size) + 0.5) * scale - 0.5).astype(np.float32)
+    sx = np.floor(fx).astype(np.int64)
+    fx = fx - sx.astype(np.float32)
+
+    s45 = 0.70710678118654752440084436210485
+    cs = [(1, 0), (-s45, -s45), (0, 1), (s45, -s45), (-1, 0), (s45, s45), (0, -1), (-s45, s45)]
+    y0 = -(fx + np.float32(3)).astype(np.float64) * math.pi * 0.25
+    s0, c0 = np.sin(y0), np.cos(y0)
+    coeffs = np.empty((out_size, 8), dtype=np.float32)
+    total = np.zeros(out_size, dtype=np.float32)
+    with np.errstate(divide='ignore', invalid='ignore'):  # fx == 0 is handled below
+        for i in range(8):
+            y = -(fx + np.float32(3 - i)).astype(np.float64) * math.pi * 0.25
+            coeffs[:, i] = (cs[i][0] * s0 + cs[i][1] * c0) / (y * y)
+            total += coeffs[:, i]
+        coeffs *= (np.float32(1) / total)[:, None]
+    exact = fx < np.finfo(np.float32).eps
+    coeffs[exact] = 0
+    coeffs[exact, 3] = 1
+
+    weights = np.rint(coeffs * np.float32(2048)).astype(np.int32)
+    index = np.clip(sx[:, None] + np.arange(-3, 5), 0, in_size - 1)
+    return index, weights
+
+
+def resize_lanczos4(img, size):
+    """Resize uint8 images on their own device, bit-exact with ``cv2.resize(..., interpolation=cv2.INTER_LANCZOS4)``.
+
+    Args:
+        img (Tensor): Images with shape (n, c, h, w) and uint8 type.
+        size (tuple[int]): Output size (h, w).
+
+    Returns:
+        Tensor: Resized images with shape (n, c, size[0], size[1]) and uint8 type.
+    """
+    index_x, weight_x = (torch.from_numpy(v).to(img.device) for v in lanczos4_table(img.shape[3], size[1]))
+    index_y, weight_y = (torch.from_numpy(v).to(img.device) for v in lanczos4_table(img.shape[2], size[0]))
+    img = img.int()
+    # horizontal then vertical pass, with the integer accumulation of OpenCV
+    tmp = sum(img[..., index_x[:, k]] * weight_x[:, k] for k in range(8))
+    output = sum(tmp[..., index_y[:, k], :] * weight_y[:, k, None] for k in range(8))
+    return ((output + (1 << 21)) >> 22).clamp_(0, 255).to(torch.uint8)
+
+
 class RealESRGANer():
     """A helper class for upsampling images with RealESRGAN.
 
@@ -24,6 +82,11 @@ class RealESRGANer():
         tile_pad (int): The pad size for each tile, to remove border artifacts. Default: 10.
         pre_pad (int): Pad the input images to avoid border artifacts. Default: 10.
         half (float): Whether to use half precision during inference. Default: False.
+        channels_last (bool): Whether to run the model in channels_last (NHWC) memory format, which lets convolutions
+            use faster Tensor Core kernels on recent GPUs. Default: False.
+        cuda_graph (bool): Whether to capture the model into a CUDA graph at the first input shape and replay it for
+            later inputs of the same shape, which removes most of the kernel launch overhead. Inputs of other shapes
+            and tiles run eagerly. It requires torch >= 1.10. Default: False.
     """
 
     def __init__(self,
@@ -36,13 +99,18 @@ class RealESRGANer():
                  pre_pad=10,
                  half=False,
                  device=None,
-                 gpu_id=None):
+                 gpu_id=None,
+                 channels_last=False,
+                 cuda_graph=False):
         self.scale = scale
         self.tile_size = tile
         self.tile_pad = tile_pad
         self.pre_pad = pre_pad
         self.mod_scale = None
         self.half = half
+        self.channels_last = channels_last
+        self.cuda_graph = cuda_graph and hasattr(torch.cuda, 'CUDAGraph')
+        self.graph = None
 
         # initialize model
         if gpu_id:
@@ -73,6 +141,8 @@ class RealESRGANer():
         self.model = model.to(self.device)
         if self.half:
             self.model = self.model.half()
+        if self.channels_last:
+            self.model = self.model.to(memory_format=torch.channels_last)
 
     def dni(self, net_a, net_b, dni_weight, key='params', loc='cpu'):
         """Deep network interpolation.
@@ -88,8 +158,9 @@ class RealESRGANer():
     def pre_process(self, img):
         """Pre-process, such as pre-pad and mod pad, so that the images can be divisible
         """
-        img = torch.from_numpy(np.transpose(img, (2, 0, 1))).float()
-        self.img = img.unsqueeze(0).to(self.device)
+        if isinstance(img, np.ndarray):
+            img = torch.from_numpy(np.transpose(img, (2, 0, 1))).unsqueeze(0)
+        self.img = img.to(self.device).float()
         if self.half:
             self.img = self.img.half()
 
@@ -109,10 +180,48 @@ class RealESRGANer():
             if (w % self.mod_scale != 0):
                 self.mod_pad_w = (self.mod_scale - w % self.mod_scale)
             self.img = F.pad(self.img, (0, self.mod_pad_w, 0, self.mod_pad_h), 'reflect')
+        if self.channels_last:
+            self.img = self.img.contiguous(memory_format=torch.channels_last)
 
     def process(self):
         # model inference
-        self.output = self.model(self.img)
+        if self.cuda_graph and self.img.is_cuda:
+            self.output = self.graph_process()
+        else:
+            self.output = self.model(self.img)
+
+    def graph_process(self):
+        """Run the model by replaying a CUDA graph captured at the first input shape.
+
+        The returned tensor is a static buffer that the next replay overwrites.
+        """
+        # the capture stream and replays belong to the current device, which is not self.device in the multi-GPU
+        # workers of the video script
+        with torch.cuda.device(self.device):
+            if self.graph is None:
+                graph_input = self.img.clone()
+                graph = torch.cuda.CUDAGraph()
+                try:
+                    # warm up on a side stream before capturing, as required by torch.cuda.graph
+                    side_stream = torch.cuda.Stream(self.device)
+                    side_stream.wait_stream(torch.cuda.current_stream(self.device))
+                    with torch.cuda.stream(side_stream):
+                        for _ in range(3):
+                            self.model(graph_input)
+                    torch.cuda.current_stream(self.device).wait_stream(side_stream)
+                    with torch.cuda.graph(graph):
+                        graph_output = self.model(graph_input)
+                except Exception:
+                    # e.g., out of memory. Later inputs run eagerly rather than replay an incomplete graph
+                    self.cuda_graph = False
+                    raise
+                self.graph, self.graph_input, self.graph_output = graph, graph_input, graph_output
+            elif self.img.shape != self.graph_input.shape or self.img.dtype != self.graph_input.dtype:
+                return self.model(self.img)
+            else:
+                self.graph_input.copy_(self.img)
+            self.graph.replay()
+            return self.graph_output
 
     def tile_process(self):
         """It will first crop input images to tiles, and then process each tile.
@@ -248,10 +357,14 @@ class RealESRGANer():
             output_img[:, :, 3] = output_alpha
 
         # ------------------------------ return ------------------------------ #
+        # scale and round in place instead of allocating two temporary float images; the values are already
+        # clamped to [0, 1], so the cast cannot overflow
+        output_img *= max_range
+        np.rint(output_img, out=output_img)
         if max_range == 65535:  # 16-bit image
-            output = (output_img * 65535.0).round().astype(np.uint16)
+            output = output_img.astype(np.uint16)
         else:
-            output = (output_img * 255.0).round().astype(np.uint8)
+            output = output_img.astype(np.uint8)
 
         if outscale is not None and outscale != float(self.scale):
             output = cv2.resize(
@@ -262,31 +375,124 @@ class RealESRGANer():
 
         return output, img_mode
 
+    @torch.no_grad()
+    def enhance_tensor(self, img, outscale=None):
+        """Upsample BGR uint8 frames given as a tensor, skipping the numpy glue of :meth:`enhance`.
+
+        All the work is queued on the current stream, so the caller decides when to synchronize.
+
+        Args:
+            img (Tensor): Input frame with shape (h, w, 3), or a batch of frames with shape (n, h, w, 3), in BGR
+                order and uint8 type. A tensor that already lives on the device avoids one more host-to-device copy.
+                Batching amortizes the per-call overhead for small models.
+            outscale (float): The final upsampling scale of the frame. Default: None.
+
+        Returns:
+            Tensor: Output frame(s) on the device with shape ([n, ]h * outscale, w * outscale, 3) in BGR order and
+                uint8 type. It is contiguous, so it can be copied to the host and written out as raw bytes directly.
+        """
+        h_input, w_input = img.shape[-3:-1]
+        batched = img.dim() == 4
+        img = img.to(self.device, non_blocking=True)
+        if not batched:
+            img = img.unsqueeze(0)
+        # NHWC-BGR uint8 -> NCHW-RGB float
+        img = img.permute(0, 3, 1, 2).flip(1).float().div_(255.)
+
+        self.pre_process(img)
+        if self.tile_size > 0:
+            self.tile_process()
+        else:
+            self.process()
+        output = self.post_process().float().clamp_(0, 1)
+
+        # NCHW-RGB float -> NHWC-BGR uint8, cast on the device so that only a quarter of the bytes are copied back
+        output = output.mul_(255.).round_().to(torch.uint8)
+        if outscale is not None and outscale != float(self.scale):
+            # the same Lanczos resize as enhance()
+            output = resize_lanczos4(output, (int(h_input * outscale), int(w_input * outscale)))
+        output = output.flip(1).permute(0, 2, 3, 1).contiguous()
+        return output if batched else output[0]
+
 
 class PrefetchReader(threading.Thread):
     """Prefetch images.
 
+    Files are read in bulk by this thread and decoded by a pool of worker threads (``cv2.imdecode`` releases the
+    GIL), so that disk IO overlaps with decoding. The order of images is kept. A file that cannot be read or decoded
+    stops the reader: its error is raised by ``next`` after the images before it.
+
     Args:
         img_list (list[str]): A image list of image paths to be read.
         num_prefetch_queue (int): Number of prefetch queue.
+        flags (int): Flags passed to ``cv2.imdecode``. Default: cv2.IMREAD_UNCHANGED.
+        num_workers (int): Number of decoding threads. Default: 4.
     """
 
-    def __init__(self, img_list, num_prefetch_queue):
+    # marks the end of the queue, so that no queued item can be mistaken for it
+    _end = object()
+
+    def __init__(self, img_list, num_prefetch_queue, flags=cv2.IMREAD_UNCHANGED, num_workers=4):
         super().__init__()
         self.que = queue.Queue(num_prefetch_queue)
         self.img_list = img_list
+        self.flags = flags
+        self.num_workers = num_workers
+        self.stop_event = threading.Event()
 
     def run(self):
-        for img_path in self.img_list:
-            img = cv2.imread(img_path, cv2.IMREAD_UNCHANGED)
-            self.que.put(img)
-
-        self.que.put(None)
+        try:
+            with ThreadPoolExecutor(self.num_workers) as executor:
+                pending = deque()
+                read_error = None
+                for img_path in self.img_list:
+                    if self.stop_event.is_set():
+                        break
+                    try:
+                        img_bytes = np.fromfile(img_path, dtype=np.uint8)
+                    except OSError as error:  # e.g., a folder or an unreadable file
+                        read_error = error
+                        break
+                    pending.append(executor.submit(self.decode, img_bytes, img_path))
+                    # bound the number of in-flight images
+                    if len(pending) >= 2 * self.num_workers:
+                        self.que.put(pending.popleft().result())
+                while pending and not self.stop_event.is_set():
+                    self.que.put(pending.popleft().result())
+                # raised to the consumer after the images before it
+                if read_error is not None:
+                    self.que.put(read_error)
+        except Exception as error:
+            self.que.put(error)
+        finally:
+            # always stop the consumer, which would otherwise wait forever
+            self.que.put(self._end)
+
+    def stop(self):
+        """Stop reading and wait for the thread to finish, e.g., when the consumer fails before the end. The
+        images left in the queue are dropped."""
+        self.stop_event.set()
+        while self.is_alive():
+            # make room for a put that blocks the thread
+            try:
+                while True:
+                    self.que.get_nowait()
+            except queue.Empty:
+                pass
+            self.join(0.1)
+
+    def decode(self, img_bytes, img_path):
+        img = cv2.imdecode(img_bytes, self.flags)
+        if img is None:
+            raise ValueError(f'Cannot decode {img_path} as an image.')
+        return img
 
     def __next__(self):
         next_item = self.que.get()
-        if next_item is None:
+        if next_item is self._end:
             raise StopIteration
+        if isinstance(next_item, Exception):
+            raise next_item
         return next_item
 
     def __iter__(self):
@@ -294,12 +500,28 @@ class PrefetchReader(threading.Thread):
 
 
 class IOConsumer(threading.Thread):
+    """Save images in background.
+
+    Encoding runs in this thread rather than in the inference loop. OpenCV releases the GIL while encoding (with
+    libjpeg-turbo for JPEG in the opencv-python wheels), so several consumers encode in parallel.
+
+    Args:
+        opt (dict | Namespace): Options.
+        que (queue.Queue): Queue of dicts with ``output`` (the image) and ``save_path`` keys, or the string 'quit'
+            to stop the thread. It should be bounded, so that producers block when saving falls behind.
+        qid (int | str): The id of this consumer.
+
+    Attributes:
+        error (Exception | None): The first error raised while saving. The thread goes on with the following
+            messages, so that producers never block on a dead consumer; producers should check it and raise it.
+    """
 
     def __init__(self, opt, que, qid):
         super().__init__()
         self._queue = que
         self.qid = qid
         self.opt = opt
+        self.error = None
 
     def run(self):
         while True:
@@ -309,5 +531,8 @@ class IOConsumer(threading.Thread):
 
             output = msg['output']
             save_path = msg['save_path']
-            cv2.imwrite(save_path, output)
-        print(f'IO worker {self.qid} is done.')
+            try:
+                cv2.imwrite(save_path, output)
+            except Exception as error:  # e.g., cv2.error for a path without a known extension
+                if self.error is None:
+                    self.error = error
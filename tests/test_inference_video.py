@@ -0,0 +1,47 @@
+import argparse
+import cv2
+import importlib.util
+import numpy as np
+import os
+import pytest
+
+
+def load_video_script():
+    pytest.importorskip('ffmpeg')
+    script_path = os.path.join(
+        os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'inference_realesrgan_video.py')
+    spec = importlib.util.spec_from_file_location('inference_realesrgan_video', script_path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def test_reader_partial_last_batch(tmp_path):
+    video_script = load_video_script()
+    imgs = [np.random.randint(0, 256, (8, 6, 3), dtype=np.uint8) for _ in range(5)]
+    for idx, img in enumerate(imgs):
+        cv2.imwrite(str(tmp_path / f'{idx:08d}.png'), img)
+
+    reader = video_script.Reader(argparse.Namespace(input=str(tmp_path), fps=None))
+    frames = reader.get_frames(4)
+    assert frames.shape == (4, 8, 6, 3)
+    # the last batch is partial
+    frames = reader.get_frames(4)
+    assert frames.shape == (1, 8, 6, 3)
+    assert np.array_equal(frames[0].numpy(), imgs[4])
+    # and the reader stays at the end instead of waiting for more frames
+    assert reader.get_frames(4) is None
+    assert reader.get_frame() is None
+    reader.close()
+
+
+def test_reader_close_before_end(tmp_path):
+    video_script = load_video_script()
+    for idx in range(10):
+        cv2.imwrite(str(tmp_path / f'{idx:08d}.png'), np.zeros((8, 6, 3), dtype=np.uint8))
+
+    # e.g., when the inference fails after the first frame
+    reader = video_script.Reader(argparse.Namespace(input=str(tmp_path), fps=None))
+    assert reader.get_frames(1).shape == (1, 8, 6, 3)
+    reader.close()
+    assert not reader.prefetch_reader.is_alive()
@@ -1,7 +1,12 @@
+import cv2
 import numpy as np
+import pytest
+import queue
+import torch
 from basicsr.archs.rrdbnet_arch import RRDBNet
 
-from realesrgan.utils import RealESRGANer
+from realesrgan.archs.srvgg_arch import SRVGGNetCompact
+from realesrgan.utils import IOConsumer, PrefetchReader, RealESRGANer, resize_lanczos4
 
 
 def test_realesrganer():
@@ -85,3 +90,110 @@ def test_realesrganer():
     result = restorer.enhance(img, outscale=2, alpha_upsampler=None)
     assert result[0].shape == (8, 8, 4)
     assert result[1] == 'RGBA'
+
+
+def test_enhance_tensor(tmp_path):
+    model = SRVGGNetCompact(num_in_ch=3, num_out_ch=3, num_feat=16, num_conv=2, upscale=4, act_type='prelu')
+    model_path = str(tmp_path / 'model.pth')
+    torch.save({'params': model.state_dict()}, model_path)
+    restorer = RealESRGANer(scale=4, model_path=model_path, model=model, pre_pad=2, device=torch.device('cpu'))
+
+    img = torch.randint(0, 256, (4, 4, 3), dtype=torch.uint8)
+    result = restorer.enhance_tensor(img, outscale=2)
+    assert result.shape == (8, 8, 3)
+    assert result.dtype == torch.uint8
+    # batch of frames
+    img = torch.randint(0, 256, (2, 4, 4, 3), dtype=torch.uint8)
+    result = restorer.enhance_tensor(img, outscale=2)
+    assert result.shape == (2, 8, 8, 3)
+    # the same output as enhance, including the Lanczos resize
+    img = np.random.randint(0, 256, (6, 5, 3), dtype=np.uint8)
+    for outscale in (4, 2.5):
+        result = restorer.enhance_tensor(torch.from_numpy(img), outscale=outscale)
+        assert np.array_equal(result.numpy(), restorer.enhance(img, outscale=outscale)[0])
+
+
+@pytest.mark.skipif(not torch.cuda.is_available(), reason='CUDA graphs require a GPU')
+def test_realesrganer_cuda_graph(tmp_path):
+    model = SRVGGNetCompact(num_in_ch=3, num_out_ch=3, num_feat=16, num_conv=2, upscale=2, act_type='prelu')
+    model_path = str(tmp_path / 'model.pth')
+    torch.save({'params': model.state_dict()}, model_path)
+    # use the last GPU, which is not the current device when there are several
+    device = torch.device('cuda', torch.cuda.device_count() - 1)
+    restorer = RealESRGANer(scale=2, model_path=model_path, model=model, device=device, cuda_graph=True)
+    # replays should follow the new inputs, not repeat the first output
+    with torch.no_grad():
+        for _ in range(2):
+            restorer.img = torch.rand(1, 3, 8, 8, device=device)
+            restorer.process()
+            output = restorer.output.clone()
+            assert torch.allclose(output, restorer.model(restorer.img), atol=1e-5)
+    assert restorer.graph is not None
+
+
+def test_resize_lanczos4():
+    img = np.random.randint(0, 256, (13, 17, 3), dtype=np.uint8)
+    for size in ((26, 34), (32, 42), (7, 9)):
+        result = resize_lanczos4(torch.from_numpy(img).permute(2, 0, 1).unsqueeze(0), size)
+        expected = cv2.resize(img, size[::-1], interpolation=cv2.INTER_LANCZOS4)
+        assert np.array_equal(result[0].permute(1, 2, 0).numpy(), expected)
+
+
+def test_prefetchreader():
+    img_list = ['tests/data/gt/baboon.png', 'tests/data/gt/comic.png'] * 5
+    reader = PrefetchReader(img_list, num_prefetch_queue=2, num_workers=2)
+    reader.start()
+    imgs = list(reader)
+    reader.join()
+    assert len(imgs) == len(img_list)
+    for img, img_path in zip(imgs, img_list):
+        assert np.array_equal(img, cv2.imread(img_path, cv2.IMREAD_UNCHANGED))
+    # a file that cannot be read stops the reader with its error
+    img_list = ['tests/data/gt/baboon.png', 'tests/data', 'tests/data/gt/baboon.png']
+    reader = PrefetchReader(img_list, num_prefetch_queue=2)
+    reader.start()
+    assert np.array_equal(next(reader), cv2.imread(img_list[0], cv2.IMREAD_UNCHANGED))
+    with pytest.raises(OSError):
+        next(reader)
+    with pytest.raises(StopIteration):
+        next(reader)
+    reader.join()
+    # so does a file that is not an image
+    img_list = ['tests/data/gt/baboon.png', 'tests/data/meta_info_gt.txt'] + ['tests/data/gt/comic.png'] * 10
+    reader = PrefetchReader(img_list, num_prefetch_queue=2, num_workers=2)
+    reader.start()
+    assert np.array_equal(next(reader), cv2.imread(img_list[0], cv2.IMREAD_UNCHANGED))
+    with pytest.raises(ValueError, match='meta_info_gt.txt'):
+        next(reader)
+    with pytest.raises(StopIteration):
+        next(reader)
+    reader.join()
+    # stop before the end, while the thread waits for room in the queue
+    reader = PrefetchReader(['tests/data/gt/baboon.png'] * 10, num_prefetch_queue=1)
+    reader.start()
+    next(reader)
+    reader.stop()
+    assert not reader.is_alive()
+
+
+def test_ioconsumer(tmp_path):
+    que = queue.Queue(maxsize=2)
+    consumer = IOConsumer(None, que, 0)
+    consumer.start()
+    imgs = [np.random.randint(0, 256, (8, 8, 3), dtype=np.uint8) for _ in range(4)]
+    for idx, img in enumerate(imgs):
+        que.put({'output': img, 'save_path': str(tmp_path / f'{idx}.png')})
+    que.put('quit')
+    consumer.join()
+    for idx, img in enumerate(imgs):
+        assert np.array_equal(cv2.imread(str(tmp_path / f'{idx}.png'), cv2.IMREAD_UNCHANGED), img)
+    assert consumer.error is None
+    # an error is kept for the producer, and the following images are still saved
+    consumer = IOConsumer(None, que, 1)
+    consumer.start()
+    que.put({'output': imgs[0], 'save_path': str(tmp_path / 'no_extension')})
+    que.put({'output': imgs[1], 'save_path': str(tmp_path / 'after_error.png')})
+    que.put('quit')
+    consumer.join()
+    assert isinstance(consumer.error, cv2.error)
+    assert np.array_equal(cv2.imread(str(tmp_path / 'after_error.png'), cv2.IMREAD_UNCHANGED), imgs[1])